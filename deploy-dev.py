@@ -5,22 +5,62 @@ This script exports the repository using gitattributes, builds the project,
 and handles committing and pushing to the test repository (memo-demo-test).
 """
 
+import functools
+import glob
+import os
+import shlex
 import shutil
 import subprocess
 import sys
+import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
+try:
+    import pygit2  # Optional, lets read-only queries run in-process via libgit2
+except ImportError:
+    pygit2 = None
+
+# Map porcelain status codes to the categories reported by get_git_status_details
+_STATUS_TYPES = {
+    "M": "modified",
+    "T": "modified",
+    "U": "modified",
+    "A": "added",
+    "C": "added",
+    "D": "deleted",
+    "R": "renamed",
+}
+
+# Environment for git subprocesses: skip optional locks so reads don't contend for .git/index.lock
+_GIT_ENV = {**os.environ, "GIT_OPTIONAL_LOCKS": "0"}
+
 
 def run_command(
-    cmd: list[str], cwd: Path | None = None, check: bool = True, silent: bool = False, text: bool = True
+    cmd: list[str],
+    cwd: Path | None = None,
+    check: bool = True,
+    silent: bool = False,
+    text: bool = True,
+    stream: bool = False,
 ) -> subprocess.CompletedProcess:
-    """Run a command and return the result."""
+    """Run a command and return the result.
+
+    With ``stream=True`` the output goes straight to the terminal instead of being captured.
+    """
+    env = _GIT_ENV if cmd[0] == "git" else None
+
     if not silent:
         print(f"Running: {' '.join(cmd)}")
 
-    result = subprocess.run(cmd, cwd=cwd, check=False, capture_output=True, text=text)
+    if stream:
+        # Flush our own buffered output so it isn't overtaken by the child's when stdout isn't a TTY
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    result = subprocess.run(cmd, cwd=cwd, env=env, check=False, capture_output=not stream, text=text)
 
     if result.returncode != 0:
         if not silent:
@@ -34,9 +74,68 @@ def run_command(
     return result
 
 
-def get_git_status_details(repo_path: Path) -> dict[str, list[str]]:
-    """Get detailed git status information."""
-    result = run_command(["git", "status", "--porcelain"], cwd=repo_path, silent=True)
+@functools.lru_cache(maxsize=8)
+def _open_pygit2_repo(repo_path: str) -> "pygit2.Repository | None":
+    """Open the repository once per process with pygit2, or return None if pygit2 isn't installed."""
+    if pygit2 is None:
+        return None
+    try:
+        return pygit2.Repository(repo_path)
+    except pygit2.GitError:
+        return None
+
+
+class GitSession:
+    """Persistent ``git cat-file --batch-check`` process for resolving revisions in a repository.
+
+    Queries are written to the same git process, so each lookup doesn't pay for starting git and opening the repo.
+    When pygit2 is installed, lookups run in-process instead and no git process is started.
+    """
+
+    def __init__(self, repo_path: Path) -> None:
+        self.repo_path = repo_path
+        self._repo = _open_pygit2_repo(str(repo_path))
+        self._proc: subprocess.Popen | None = None
+
+    def __enter__(self) -> "GitSession":
+        if self._repo is not None:
+            return self
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", "--batch-check=%(objectname) %(objecttype)"],
+            cwd=self.repo_path,
+            env=_GIT_ENV,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._proc.wait()
+            self._proc.stdout.close()
+
+    def resolve(self, rev: str) -> str | None:
+        """Return the object name that rev resolves to, or None if it doesn't exist."""
+        if self._repo is not None:
+            try:
+                return str(self._repo.revparse_single(rev).id)
+            except (KeyError, ValueError, pygit2.GitError):
+                return None
+
+        self._proc.stdin.write(f"{rev}\n")
+        self._proc.stdin.flush()
+        # Unresolvable revisions are echoed back as "<rev> missing" (or "<rev> ambiguous")
+        object_name, _, object_type = self._proc.stdout.readline().rstrip("\n").rpartition(" ")
+        if object_type in ("missing", "ambiguous") or not object_name:
+            return None
+        return object_name
+
+
+def get_git_status_details(repo_path: Path, *args: str) -> dict[str, list[str]]:
+    """Get detailed git status information, passing any extra args to git status."""
+    result = run_command(["git", "status", "--porcelain", *args], cwd=repo_path, silent=True)
     status = {
         "modified": [],
         "added": [],
@@ -45,94 +144,137 @@ def get_git_status_details(repo_path: Path) -> dict[str, list[str]]:
         "untracked": [],
     }
 
-    for line in result.stdout.strip().split("\n"):
-        if not line:
-            continue
-        
-        # Git porcelain format is reliable:
-        # First two characters are status codes (XY)
-        # Third character is always a space
-        # Rest is the filename
-        # Use regex or just be very explicit
-        parts = line.split(None, 1)  # Split on first whitespace only
-        if len(parts) != 2:
+    # Porcelain v1 is fixed-width: two status codes (XY), a space, then the path.
+    # Don't strip stdout, a leading space is a valid X code (e.g. " M file").
+    for line in result.stdout.splitlines():
+        xy, filename = line[:2], line[3:]
+        if xy == "??":
+            status["untracked"].append(filename)
             continue
-            
-        status_code = parts[0]
-        filename = parts[1]
-        
-        # Handle the status codes properly
-        if len(status_code) >= 1:
-            if "M" in status_code:
-                status["modified"].append(filename)
-            elif "A" in status_code:
-                status["added"].append(filename)
-            elif "D" in status_code:
-                status["deleted"].append(filename)
-            elif "R" in status_code:
-                status["renamed"].append(filename)
-            elif status_code == "??":
-                status["untracked"].append(filename)
+        # Prefer the index (X) code and fall back to the worktree (Y) code
+        status_type = _STATUS_TYPES.get(xy[0]) or _STATUS_TYPES.get(xy[1:2])
+        if status_type:
+            status[status_type].append(filename)
 
     return status
 
 
 def check_uncommitted_files(repo_path: Path) -> list[str]:
     """Check for uncommitted files in the repository, ignoring ./docs directory."""
-    status = get_git_status_details(repo_path)
-
-    uncommitted = []
-    for status_type, files in status.items():
-        for file in files:
-            file_path = Path(file)
-            # Ignore files in ./docs directory
-            if file_path.parts and file_path.parts[0] == "docs":
-                continue
-            uncommitted.append(file)
-
-    return uncommitted
+    # Let git skip ./docs itself rather than listing (and walking) it only to filter it out
+    status = get_git_status_details(
+        repo_path, "--untracked-files=normal", "--ignore-submodules", "--", ":(top)", ":(exclude,top)docs"
+    )
+    return [file for files in status.values() for file in files]
+
+
+def has_changes_to_commit(repo_path: Path) -> bool:
+    """Check whether there is anything to commit, without listing every changed file."""
+    # Check in the order changes usually show up in a fresh export (edited files, new files, staged files),
+    # so a deploy with changes usually stops after the first one or two checks
+    # git diff --quiet stops at the first difference and reports it through the exit code
+    if run_command(["git", "diff", "--quiet"], cwd=repo_path, check=False, silent=True).returncode != 0:
+        return True
+    # --directory reports untracked directories without descending into them
+    untracked = run_command(
+        ["git", "ls-files", "--others", "--exclude-standard", "--directory", "--no-empty-directory"],
+        cwd=repo_path,
+        silent=True,
+    )
+    if untracked.stdout.strip():
+        return True
+    staged = run_command(["git", "diff", "--quiet", "--cached"], cwd=repo_path, check=False, silent=True)
+    return staged.returncode != 0
 
 
 def get_current_branch(repo_path: Path) -> str:
-    """Get the current git branch."""
+    """Get the current git branch (empty if HEAD is detached)."""
+    # Read the symbolic ref directly rather than spawning git, unless .git is a file (worktree/submodule)
+    # or the repo uses the reftable backend (its HEAD file is a "refs/heads/.invalid" stub)
+    git_dir = repo_path / ".git"
+    head_path = git_dir / "HEAD"
+    if head_path.is_file() and not (git_dir / "reftable").exists():
+        head = head_path.read_text().strip()
+        branch = head.removeprefix("ref: refs/heads/") if head.startswith("ref: refs/heads/") else ""
+        if branch != ".invalid":
+            return branch
     result = run_command(["git", "branch", "--show-current"], cwd=repo_path, silent=True)
     return result.stdout.strip()
 
 
 def get_latest_tag(repo_path: Path) -> str | None:
-    """Get the latest git tag."""
-    try:
-        result = run_command(["git", "describe", "--tags", "--abbrev=0"], cwd=repo_path, check=False, silent=True)
-        if result.returncode == 0:
-            return result.stdout.strip()
-    except subprocess.CalledProcessError:
-        pass
+    """Get the most recently created git tag."""
+    repo = _open_pygit2_repo(str(repo_path))
+    if repo is not None:
+        return _latest_tag_pygit2(repo)
+
+    # Sorting refs by creation date avoids the history walk that git describe does
+    result = run_command(
+        ["git", "for-each-ref", "--sort=-creatordate", "--count=1", "--format=%(refname:short)", "refs/tags"],
+        cwd=repo_path,
+        check=False,
+        silent=True,
+    )
+    if result.returncode == 0:
+        return result.stdout.strip() or None
     return None
 
 
+def _latest_tag_pygit2(repo: "pygit2.Repository") -> str | None:
+    """Get the most recently created tag in-process, using the same creatordate ordering as git for-each-ref."""
+
+    def creator_date(ref_name: str) -> int:
+        target = repo.revparse_single(ref_name)
+        if isinstance(target, pygit2.Tag) and target.tagger is not None:
+            return target.tagger.time
+        try:
+            return target.peel(pygit2.Commit).commit_time
+        except (ValueError, pygit2.GitError):
+            # Tags of blobs/trees have no date, for-each-ref sorts those last too
+            return -1
+
+    tags = [ref_name for ref_name in repo.listall_references() if ref_name.startswith("refs/tags/")]
+    if not tags:
+        return None
+    return max(tags, key=creator_date).removeprefix("refs/tags/")
+
+
 def build_project_check(project_path: Path) -> bool:
     """Run build to verify it works before deployment."""
     print("\n🔨 Running build check...")
     try:
-        result = run_command(["task", "build"], cwd=project_path)
+        run_command(["task", "build"], cwd=project_path, stream=True)
         print("✅ Build check passed")
         return True
-    except subprocess.CalledProcessError as e:
-        print("❌ Build check failed!")
-        print(f"Error: {e.stderr if e.stderr else 'Unknown error'}")
+    except subprocess.CalledProcessError:
+        print("❌ Build check failed! (see output above)")
         return False
 
 
-def export_repository(source_path: Path, target_path: Path, ref: str = "HEAD") -> None:
-    """Export repository using git archive and gitattributes."""
+def export_repository(source_git: GitSession, target_path: Path, ref: str = "HEAD") -> subprocess.Popen:
+    """Export repository using git archive and gitattributes.
+
+    Returns the background process deleting the replaced tree, so the caller can wait for it.
+    """
+    source_path = source_git.repo_path
+
     # Verify ref exists
-    try:
-        ref_result = run_command(["git", "rev-parse", ref], cwd=source_path, silent=True)
-        ref_commit = ref_result.stdout.strip()[:8]
-        print(f"\n📦 Exporting from {ref} (commit {ref_commit})")
-    except subprocess.CalledProcessError:
+    ref_commit = source_git.resolve(f"{ref}^{{commit}}")
+    if ref_commit is None:
         print(f"❌ Error: ref '{ref}' not found")
         sys.exit(1)
+    print(f"\n📦 Exporting from {ref} (commit {ref_commit[:8]})")
+
+    # The export is extracted into a fresh sibling directory that gets swapped into place afterwards,
+    # while the old tree is moved aside into a hidden ".<name>.old-*" directory. If either of those
+    # still holds a .git, an earlier run was interrupted mid-swap and it has the target's history.
+    staging_path = target_path.with_name(f"{target_path.name}.new")
+    stale_tree_glob = f".{glob.escape(target_path.name)}.old-*/{glob.escape(target_path.name)}"
+    for leftover_path in [staging_path, *target_path.parent.glob(stale_tree_glob)]:
+        if (leftover_path / ".git").exists():
+            print(f"❌ Error: {leftover_path} contains the repository's .git from an interrupted run")
+            print(f"Move it back to {target_path} (or delete {leftover_path}) and try again.")
+            sys.exit(1)
 
     # Ensure target directory exists
     target_path.parent.mkdir(parents=True, exist_ok=True)
@@ -142,38 +284,44 @@ def export_repository(source_path: Path, target_path: Path, ref: str = "HEAD") -
     target_git = target_path / ".git"
     if not target_git.exists():
         print("Initializing new git repository in development directory...")
-        run_command(["git", "init"], cwd=target_path)
         # Add remote if it doesn't exist
-        run_command(["git", "remote", "add", "origin", "https://github.com/daeh/memo-demo-test.git"], 
-                   cwd=target_path, check=False, silent=True)
+        remote_cmd = shlex.join(["git", "remote", "add", "origin", "https://github.com/daeh/memo-demo-test.git"])
+        run_command(["/bin/sh", "-c", f"git init && {{ {remote_cmd} || true; }}"], cwd=target_path)
     else:
         print("Using existing git repository")
 
-    # Clean existing files (except .git)
-    print("Cleaning existing files (preserving .git)...")
-    for item in target_path.iterdir():
-        if item.name == ".git":
-            continue
-        if item.is_dir():
-            shutil.rmtree(item)
-        else:
-            item.unlink()
+    shutil.rmtree(staging_path, ignore_errors=True)  # Left over from an interrupted run
+    staging_path.mkdir()
 
     # Create archive using git archive (respects .gitattributes)
     print(f"Creating archive from {ref}...")
+    # Pipe the archive straight into tar at the OS level (no Python-side buffer)
     archive_cmd = ["git", "archive", "--format=tar", ref]
-    archive_result = run_command(archive_cmd, cwd=source_path, text=False)
-
-    # Extract archive to target directory
     extract_cmd = ["tar", "-x"]
-    try:
-        subprocess.run(extract_cmd, cwd=target_path, input=archive_result.stdout, check=True)
-    except subprocess.CalledProcessError as e:
+    print(f"Running: {' '.join(archive_cmd)} | {' '.join(extract_cmd)}")
+    archive_proc = subprocess.Popen(archive_cmd, cwd=source_path, env=_GIT_ENV, stdout=subprocess.PIPE)
+    extract_proc = subprocess.Popen(extract_cmd, cwd=staging_path, stdin=archive_proc.stdout)
+    archive_proc.stdout.close()  # Let git archive receive SIGPIPE if tar exits early
+    extract_proc.wait()
+    if archive_proc.wait() != 0:
+        raise subprocess.CalledProcessError(archive_proc.returncode, archive_cmd)
+    if extract_proc.returncode != 0:
         # This is expected if some files are excluded by gitattributes
         print("Note: Some files may have been excluded by .gitattributes")
 
+    # Swap the export into place (preserving .git) with renames instead of deleting file by file
+    print("Replacing existing files (preserving .git)...")
+    # Move the old tree aside before taking its .git, so .git is never left only in the staging directory
+    stale_path = Path(tempfile.mkdtemp(prefix=f".{target_path.name}.old-", dir=target_path.parent))
+    target_path.rename(stale_path / target_path.name)
+    (stale_path / target_path.name / ".git").rename(staging_path / ".git")
+    staging_path.rename(target_path)
+
     print("✅ Export completed")
 
+    # Delete the old tree in the background, it's off the critical path
+    return subprocess.Popen(["rm", "-rf", str(stale_path)], start_new_session=True)
+
 
 def build_project(project_path: Path) -> None:
     """Build the project using task build."""
@@ -183,37 +331,24 @@ def build_project(project_path: Path) -> None:
     if (project_path / "pyproject.toml").exists():
         print("Running uv sync...")
         try:
-            result = run_command(["uv", "sync"], cwd=project_path)
-            if result.stdout:
-                print(result.stdout)
-        except subprocess.CalledProcessError as e:
+            run_command(["uv", "sync"], cwd=project_path, stream=True)
+        except subprocess.CalledProcessError:
             print("❌ uv sync failed!")
-            if e.stdout:
-                print(f"Output: {e.stdout}")
-            if e.stderr:
-                print(f"Error: {e.stderr}")
             sys.exit(1)
     
     # Run task build
     try:
-        result = run_command(["task", "build"], cwd=project_path)
-        if result.stdout:
-            print(result.stdout)
+        run_command(["task", "build"], cwd=project_path, stream=True)
         print("✅ Build completed successfully")
-    except subprocess.CalledProcessError as e:
+    except subprocess.CalledProcessError:
         print("❌ Build failed!")
-        if e.stdout:
-            print(f"Output: {e.stdout}")
-        if e.stderr:
-            print(f"Error: {e.stderr}")
         sys.exit(1)
 
 
 def commit_and_push(repo_path: Path, commit_message: str = None) -> None:
     """Commit changes and push to remote."""
     # Check if there are changes to commit
-    status_result = run_command(["git", "status", "--porcelain"], cwd=repo_path, silent=True)
-    if not status_result.stdout.strip():
+    if not has_changes_to_commit(repo_path):
         print("\n✅ No changes to commit.")
         return
 
@@ -228,10 +363,6 @@ def commit_and_push(repo_path: Path, commit_message: str = None) -> None:
             if len(files) > 3:
                 print(f"    ... and {len(files) - 3} more")
 
-    # Stage all changes
-    print("\nStaging all changes...")
-    run_command(["git", "add", "-A"], cwd=repo_path)
-
     # Use provided commit message or generate one
     if not commit_message:
         from datetime import datetime
@@ -239,30 +370,27 @@ def commit_and_push(repo_path: Path, commit_message: str = None) -> None:
     
     print(f"Commit message: {commit_message}")
 
-    # Commit changes
+    # Stage and commit in a single shell invocation (raises with its own error on failure)
     print("Committing changes...")
-    run_command(["git", "commit", "-m", commit_message], cwd=repo_path)
+    git_cmds = [["git", "add", "-A"], ["git", "commit", "-m", commit_message]]
+    run_command(["/bin/sh", "-c", " && ".join(map(shlex.join, git_cmds))], cwd=repo_path)
 
-    # Push to remote
+    # Push to remote, kept separate so only push errors reach the retry logic below
     print("\n📤 Pushing to test repository...")
     
-    # Check current branch
-    branch_result = run_command(["git", "branch", "--show-current"], cwd=repo_path, silent=True)
-    current_branch = branch_result.stdout.strip() or "main"
-    
     # Try regular push first
     push_result = run_command(["git", "push"], cwd=repo_path, check=False, silent=True)
     
     if push_result.returncode != 0:
+        # Check current branch (only needed for the retries below)
+        current_branch = get_current_branch(repo_path) or "main"
+
         if "no upstream branch" in push_result.stderr.lower():
             print(f"Setting upstream branch and pushing...")
             push_result = run_command(["git", "push", "-u", "origin", current_branch], cwd=repo_path, check=False)
         elif "rejected" in push_result.stderr.lower() or "fetch first" in push_result.stderr.lower():
             print("Remote has diverged. Force pushing...")
             push_result = run_command(["git", "push", "-f", "origin", current_branch], cwd=repo_path, check=False)
-        else:
-            # Show the error if it's not an expected issue
-            push_result = run_command(["git", "push"], cwd=repo_path, check=False)
     
     if push_result.returncode != 0:
         if "repository not found" in push_result.stderr.lower() or "could not read from remote" in push_result.stderr.lower():
@@ -287,15 +415,20 @@ def main():
     print(f"Target repository: {target_path}")
     print(f"Remote repository: memo-demo-test")  # Changed from memo-demo
 
-    # Show current git info
-    current_branch = get_current_branch(source_path)
-    latest_tag = get_latest_tag(source_path)
+    # Show current git info and check for uncommitted files (ignoring ./docs)
+    # These reads are independent, so overlap their git process startups
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        branch_future = executor.submit(get_current_branch, source_path)
+        tag_future = executor.submit(get_latest_tag, source_path)
+        uncommitted_future = executor.submit(check_uncommitted_files, source_path)
+    current_branch = branch_future.result()
+    latest_tag = tag_future.result()
+    uncommitted = uncommitted_future.result()
+
     print("\nGit Status:")
     print(f"  Current branch: {current_branch}")
     print(f"  Latest tag: {latest_tag or 'No tags found'}")
 
-    # Check for uncommitted files (ignoring ./docs)
-    uncommitted = check_uncommitted_files(source_path)
     export_ref = "HEAD"
 
     if uncommitted:
@@ -322,7 +455,8 @@ def main():
     print("\n🚀 Starting deployment...")
 
     # Export repository
-    export_repository(source_path, target_path, export_ref)
+    with GitSession(source_path) as source_git:
+        cleanup_proc = export_repository(source_git, target_path, export_ref)
 
     # Build the project
     build_project(target_path)
@@ -334,6 +468,9 @@ def main():
         commit_msg = ' '.join(sys.argv[1:])
     commit_and_push(target_path, commit_msg)
 
+    # Let the background removal of the old export finish
+    cleanup_proc.wait()
+
     print("\n✅ Development deployment completed!")
     print(f"📁 Test repository at: {target_path}")
     print(f"🌐 View at: https://daeh.github.io/memo-demo-test/")